@@ -4,13 +4,24 @@
 # -------------------------------------------------------------
 
 import streamlit as st
+import pandas as pd
 import re
 import os
-import json
+import threading
+import time
+import orjson
 from io import BytesIO
+from html import escape
 from datetime import datetime
-from anthropic import Anthropic
-import xml.etree.ElementTree as ET
+from anthropic import Anthropic, APIError, Timeout
+
+# XML support: prefer lxml (C parser, recovers from malformed output), fall back to stdlib
+try:
+    from lxml import etree as ET
+    lxml_supported = True
+except ImportError:
+    import xml.etree.ElementTree as ET
+    lxml_supported = False
 
 # PDF support
 try:
@@ -25,22 +36,101 @@ except ImportError:
 
 # Config
 CLAUDE_MODEL = "claude-sonnet-4-5"
-MAX_CLAUDE_TOKENS = 4000
+MAX_CLAUDE_TOKENS = 4000  # output budget per question
+MAX_BATCH_TOKENS = 32000  # output cap for a whole batched request
 PROJECTS_FILE = "projects.json"
 COST_PER_TOKEN = 0.00001  # USD per token
+PREVIEW_INTERVAL = 0.1  # seconds between live preview repaints
+SUMMARIES_RE = re.compile(r"<Summaries>[\s\S]*?</Summaries>")
+TOKEN_RE = re.compile(r"\w{1,6}|[^\w\s]")  # word pieces and punctuation ≈ BPE tokens
+
+# Prompt pieces that never change between generations
+XML_TEMPLATE = """
+<Summaries>
+  <Summary q_id=\"1\">
+    <Executive>
+      <Item><![CDATA[Bullet text]]></Item>
+    </Executive>
+    <Narrative><![CDATA[Narrative text]]></Narrative>
+    <Ideas>
+      <Idea><![CDATA[Idea text]]></Idea>
+    </Ideas>
+    <Quotes>
+      <Quote id=\"RESP_001\"><![CDATA[Quote text]]></Quote>
+    </Quotes>
+  </Summary>
+</Summaries>
+"""
+PROMPT_STATIC = (
+    "You are a senior qualitative research analyst and business strategy consultant. "
+    "For each interview question listed after the template below, generate exactly:\n"
+    "- Executive Summary: 6–8 bullets, each 2–3 sentences\n"
+    "- Narrative Summary: at least 400 words\n"
+    "- Ideas Worth Exploring: 6–8 bullets, each 2–3 sentences\n"
+    "- Top 5 Quotes: verbatim with respondent IDs\n"
+    "Return only valid XML matching the template below, one <Summary> per question with q_id set to the question number.\n" +
+    XML_TEMPLATE
+)
+
+def _nonblank(s):
+    return (line for line in map(str.strip, s.splitlines()) if line)
+
+def _new_summary():
+    return {"q_id": None, "execs": [], "narrative": "", "ideas": [], "quotes": []}
+
+def parse_summaries(text):
+    # Single incremental pass over <Summaries>, freeing each element once read.
+    # iterparse builds its own parser per call (lxml parsers are not thread-safe).
+    src = BytesIO(text.encode("utf-8"))
+    if lxml_supported:
+        events = ET.iterparse(src, events=("end",), recover=True, huge_tree=False)
+    else:
+        events = ET.iterparse(src, events=("end",))
+    summaries, current = [], _new_summary()
+    for _, el in events:
+        if el.tag == "Item": current["execs"].append(el.text or "")
+        elif el.tag == "Idea": current["ideas"].append(el.text or "")
+        elif el.tag == "Quote": current["quotes"].append((el.get('id'), el.text or ""))
+        elif el.tag == "Narrative": current["narrative"] = el.text or ""
+        elif el.tag == "Summary":
+            current["q_id"] = el.get('q_id')
+            summaries.append(current)
+            current = _new_summary()
+        else:
+            continue
+        el.clear()
+    return summaries
+
+# Load or init projects (once per process; reruns share the cached dict)
+@st.cache_resource(show_spinner=False)
+def load_projects():
+    if os.path.exists(PROJECTS_FILE):
+        with open(PROJECTS_FILE, "rb") as f:
+            return orjson.loads(f.read())
+    return {}
+
+# Sessions run on separate threads and share the cached dict, so serialise writes
+@st.cache_resource(show_spinner=False)
+def projects_lock():
+    return threading.Lock()
 
-# Load or init projects
-if os.path.exists(PROJECTS_FILE):
-    with open(PROJECTS_FILE, "r") as f:
-        projects = json.load(f)
-else:
-    projects = {}
+def save_projects(projects):
+    tmp = PROJECTS_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(orjson.dumps(projects, option=orjson.OPT_INDENT_2))
+    os.replace(tmp, PROJECTS_FILE)
+
+projects = load_projects()
 
 # Session context
 default_ctx = st.session_state.get("context", {})
 
-# Initialize Claude client
-client = Anthropic(api_key=st.secrets.get("ANTHROPIC_API_KEY", ""))
+# Initialize Claude client once per API key so its connection pool survives reruns
+@st.cache_resource(show_spinner=False)
+def get_client(api_key):
+    return Anthropic(api_key=api_key, max_retries=2, timeout=Timeout(60.0, connect=5.0))
+
+client = get_client(st.secrets.get("ANTHROPIC_API_KEY", ""))
 
 # Streamlit page config
 st.set_page_config(page_title="Opticom's OptiCoder", layout="wide")
@@ -70,32 +160,95 @@ with st.expander("1. Project Context", expanded=True):
         objectives = st.text_area("Project Objectives", value=defaults.get("objectives",""), height=80)
     with c2:
         questions_raw = st.text_area("Interview Questions (one per line)", value="\n".join(defaults.get("questions",[])), height=120)
-    questions = [q.strip() for q in questions_raw.split("\n") if q.strip()]
+    questions = list(_nonblank(questions_raw))
     ctx = {"project_no": project_no, "client_name": client_name, "industry": industry,
            "resp_type": resp_type, "objectives": objectives, "questions": questions}
     st.session_state["context"] = ctx
-    if project_no:
-        projects[project_no] = ctx
-        with open(PROJECTS_FILE, "w") as f:
-            json.dump(projects, f, indent=2)
+    # Only touch disk when the context actually changed
+    if project_no and projects.get(project_no) != ctx:
+        with projects_lock():
+            projects[project_no] = ctx
+            save_projects(projects)
 
 # Step 2: Responses
 with st.expander("2. Paste Responses", expanded=True):
     st.markdown("One per line: `RESP_001 — answer text`.")
     raw = st.text_area("Responses", height=300, key="raw")
 
-# Cost estimate
-_tokens = max(1, len(raw or "")//4)
+# Cost estimate (cached per raw value, so reruns with unchanged responses are free)
+@st.cache_data(show_spinner=False)
+def count_tokens(s):
+    return max(1, sum(1 for _ in TOKEN_RE.finditer(s)))
+
+_tokens = count_tokens(raw or "")
 _cost_sek = _tokens * COST_PER_TOKEN * 10
 st.info(f"🔢 Estimated tokens: {_tokens} → Cost ≈ {_cost_sek:.2f} SEK")
 
-# Generate summaries
-if st.button("📝 Generate Summaries"):
+# PDF builder
+@st.cache_resource(show_spinner=False)
+def pdf_styles():
+    styles = getSampleStyleSheet()
+    return styles['BodyText'], styles['Heading2']
+
+@st.cache_data(show_spinner=False)
+def logo_size(path, mtime):
+    # mtime is part of the cache key so a replaced logo is re-read
+    with PILImage.open(path) as img:
+        return img.size
+
+def bullet_paragraph(lines, style):
+    # One flowable for the whole list: a single layout pass instead of one per line
+    return Paragraph("<br/>".join(f"• {escape(line)}" for line in lines if line.strip()), style)
+
+# Cached on the content of ctx + summaries, so identical output never rebuilds the PDF;
+# bounded so generated reports don't accumulate in server memory
+@st.cache_data(show_spinner=False, max_entries=16)
+def build_pdf(ctx, summaries):
+    buf = BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=A4, invariant=True, pageCompression=1,
+        leftMargin=15*mm, rightMargin=15*mm, topMargin=15*mm, bottomMargin=15*mm)
+    normal, heading = pdf_styles()
+    elems = []
+    # Logo with aspect ratio
+    if os.path.exists(logo_path):
+        width, height = logo_size(logo_path, os.path.getmtime(logo_path))
+        ratio = height/width
+        elems.append(RLImage(logo_path, width=40*mm, height=40*mm*ratio))
+    # Metadata including questions
+    meta = f"Project {escape(ctx['project_no'])} | Client: {escape(ctx['client_name'])} | Industry: {escape(ctx['industry'])} | Generated: {datetime.now():%Y-%m-%d %H:%M}"
+    elems.append(Paragraph(meta, normal)); elems.append(Spacer(1,5*mm))
+    elems.append(Paragraph("Questions:", heading));
+    elems.append(bullet_paragraph(ctx['questions'], normal))
+    elems.append(PageBreak())
+    for n, summ in enumerate(summaries, 1):
+        # Exec page
+        elems.append(Paragraph(f"Q{n}. {escape(summ['question'])}", heading))
+        elems.append(Paragraph("Executive Summary", heading))
+        elems.append(bullet_paragraph(summ['execs'], normal))
+        elems.append(PageBreak())
+        # Narrative page
+        elems.append(Paragraph(f"Q{n} — Narrative Summary", heading))
+        elems.append(Paragraph(escape(summ['narrative']), normal)); elems.append(PageBreak())
+        # Ideas page
+        elems.append(Paragraph(f"Q{n} — Ideas Worth Exploring", heading))
+        elems.append(bullet_paragraph(summ['ideas'], normal))
+        elems.append(PageBreak())
+        # Quotes page
+        elems.append(Paragraph(f"Q{n} — Top Quotes", heading))
+        elems.append(Paragraph("<br/><br/>".join(
+            f"<b>{escape(rid or '')}</b>: {escape(txt)}" for rid, txt in summ['quotes']), normal))
+        if n < len(summaries): elems.append(PageBreak())
+    doc.build(elems)
+    return buf.getvalue()
+
+# Generate summaries: one Claude call, returning everything the result view needs
+def generate(ctx, raw):
     if not raw.strip(): st.error("Paste responses."); st.stop()
     if not ctx.get("questions"): st.error("Enter at least one question."); st.stop()
 
-    # Build prompt header with questions
-    questions_list = "\n".join(f"- {q}" for q in ctx['questions'])
+    # Build prompt header with numbered questions; all questions go out in one request
+    n_questions = len(ctx['questions'])
+    questions_list = "\n".join(f"{i}. {q}" for i, q in enumerate(ctx['questions'], 1))
     header = f"""
 Project: {ctx['project_no']} | Client: {ctx['client_name']} | Industry: {ctx['industry']}
 Objectives: {ctx['objectives']}
@@ -103,117 +256,120 @@ Respondent Type: {ctx['resp_type']}
 Questions:
 {questions_list}
 
+Remember, you have to answer {n_questions} questions, plan in advance so every question gets a complete <Summary>.
 """
-    xml_template = """
-<Summary>
-  <Executive>
-    <Item><![CDATA[Bullet text]]></Item>
-  </Executive>
-  <Narrative><![CDATA[Narrative text]]></Narrative>
-  <Ideas>
-    <Idea><![CDATA[Idea text]]></Idea>
-  </Ideas>
-  <Quotes>
-    <Quote id=\"RESP_001\"><![CDATA[Quote text]]></Quote>
-  </Quotes>
-</Summary>
-"""
-    prompt = (
-        header +
-        "You are a senior qualitative research analyst and business strategy consultant. Generate exactly:\n"
-        "- Executive Summary: 6–8 bullets, each 2–3 sentences\n"
-        "- Narrative Summary: at least 400 words\n"
-        "- Ideas Worth Exploring: 6–8 bullets, each 2–3 sentences\n"
-        "- Top 5 Quotes: verbatim with respondent IDs\n"
-        "Return only valid XML matching the template below.\n" +
-        xml_template +
-        f"\nRaw Responses:\n{raw}\n"
-    )
+    # One breakpoint on the last block caches the whole prompt: instructions and header alone
+    # fall below Anthropic's 1024-token minimum, and re-runs resend the same raw responses
+    content = [
+        {"type": "text", "text": PROMPT_STATIC},
+        {"type": "text", "text": header},
+        {"type": "text", "text": f"\nRaw Responses:\n{raw}\n", "cache_control": {"type": "ephemeral"}},
+    ]
+    # Stream tokens into a live preview; parse only once the message is complete
+    # Connection/auth problems surface on the first event, so no separate health check is needed
+    preview = st.empty()
     with st.spinner("🤖 Claude is thinking…"):
-        response = client.messages.create(
-            model=CLAUDE_MODEL, max_tokens=MAX_CLAUDE_TOKENS,
-            temperature=0.3,
-            messages=[{"role":"user","content":prompt}]
-        ).content[0].text.strip()
-
-    # XML parsing
-    m = re.search(r"<Summary>[\s\S]*?</Summary>", response)
-    if not m:
-        st.error("❌ Parsing error: <Summary> missing.")
+        try:
+            with client.messages.stream(
+                model=CLAUDE_MODEL, max_tokens=min(MAX_CLAUDE_TOKENS * n_questions, MAX_BATCH_TOKENS),
+                temperature=0.3,
+                messages=[{"role":"user","content":content}]
+            ) as stream:
+                # Repaint at most every PREVIEW_INTERVAL: each repaint resends the whole buffer
+                chunks, last_paint = [], time.monotonic()
+                for text in stream.text_stream:
+                    chunks.append(text)
+                    if time.monotonic() - last_paint >= PREVIEW_INTERVAL:
+                        preview.code("".join(chunks), language="xml")
+                        last_paint = time.monotonic()
+                preview.code("".join(chunks), language="xml")
+                final = stream.get_final_message()
+                response = final.content[0].text.strip()
+        except APIError as e:
+            preview.empty()
+            st.error(f"❌ Claude API error: {e}")
+            st.stop()
+    preview.empty()
+
+    # XML parsing; a response cut off at max_tokens keeps every <Summary> that completed
+    truncated = final.stop_reason == "max_tokens"
+    start = response.find("<Summaries>")
+    m = SUMMARIES_RE.search(response, max(start, 0))
+    end = response.rfind("</Summary>")
+    if m:
+        xml = m.group(0)
+    elif truncated and 0 <= start < end:
+        xml = response[start:end + len("</Summary>")] + "</Summaries>"
+    else:
+        st.error("❌ Parsing error: <Summaries> missing." +
+                 (" Claude hit the output limit before finishing any question." if truncated else ""))
         st.text_area("Raw response", response, height=300)
         st.stop()
-    xml = m.group(0)
     try:
-        root = ET.fromstring(xml)
+        summaries = parse_summaries(xml)
     except ET.ParseError as e:
         st.error(f"❌ XML parse error: {e}")
         st.text_area("XML", xml, height=300)
         st.stop()
 
-    # Extract sections
-    execs = [i.text or "" for i in root.find('Executive').findall('Item')]
-    narrative = root.findtext('Narrative','')
-    ideas = [i.text or "" for i in root.find('Ideas').findall('Idea')]
-    quotes = [(q.get('id'), q.text or "") for q in root.find('Quotes').findall('Quote')]
-
-    # Display unified boxes
-    tabs = st.tabs(["Executive","Narrative","Ideas","Quotes"])
-    with tabs[0]:
-        exec_text = "\n".join(execs)
-        st.text_area("Executive Summary", exec_text, height=200, key="exec_summary")
-    with tabs[1]:
-        st.text_area("Narrative Summary", narrative, height=300, key="narrative_summary")
-    with tabs[2]:
-        ideas_text = "\n".join(ideas)
-        st.text_area("Ideas Worth Exploring", ideas_text, height=200, key="ideas_summary")
-    with tabs[3]:
-        for rid, txt in quotes:
-            st.text_area(f"Quote {rid}", txt, height=100, disabled=False, key=f"quote_{rid}")
+    # Attach question text per summary
+    q_by_id = {str(i): q for i, q in enumerate(ctx['questions'], 1)}
+    for summ in summaries:
+        summ["question"] = q_by_id.get(summ["q_id"], summ["q_id"] or "")
+    if not summaries:
+        st.error("❌ Parsing error: no <Summary> blocks returned.")
+        st.text_area("XML", xml, height=300)
+        st.stop()
+    return {"ctx": ctx, "summaries": summaries, "response": response,
+            "truncated": truncated, "n_questions": n_questions,
+            "run": st.session_state.get("generation", {}).get("run", 0) + 1}
+
+def next_question():
+    # raw belongs to a widget outside the fragment, so it can only be cleared here;
+    # the flag makes the next fragment run rerun the whole app to redraw it
+    st.session_state.raw = ""
+    st.session_state.pop("generation", None)
+    st.session_state["_next_question"] = True
+
+# Result view: a fragment, so its widgets rerun only this block and redraw from session state
+@st.fragment
+def generation_block(ctx, raw):
+    if st.session_state.pop("_next_question", False): st.rerun()
+    if st.button("📝 Generate Summaries") or st.session_state.pop("_regenerate", False):
+        st.session_state["generation"] = generate(ctx, raw)
+    gen = st.session_state.get("generation")
+    if not gen: return
+    ctx, summaries, run = gen["ctx"], gen["summaries"], gen["run"]
+
+    if gen["truncated"]:
+        st.warning(f"⚠️ Claude hit the output limit: only {len(summaries)} of {gen['n_questions']} questions were "
+                   "summarised. Split the questions across runs to cover the rest.")
+
+    # Display unified boxes, one tab group per question; keys carry the run so a new generation resets them
+    quote_tables = [pd.DataFrame(summ['quotes'], columns=["id","quote"]) for summ in summaries]
+    for n, summ in enumerate(summaries, 1):
+        st.subheader(f"Q{n}. {summ['question']}")
+        tabs = st.tabs(["Executive","Narrative","Ideas","Quotes"])
+        with tabs[0]:
+            st.text_area("Executive Summary", "\n".join(summ['execs']), height=200, key=f"exec_summary_{run}_{n}")
+        with tabs[1]:
+            st.text_area("Narrative Summary", summ['narrative'], height=300, key=f"narrative_summary_{run}_{n}")
+        with tabs[2]:
+            st.text_area("Ideas Worth Exploring", "\n".join(summ['ideas']), height=200, key=f"ideas_summary_{run}_{n}")
+        with tabs[3]:
+            st.dataframe(quote_tables[n-1], use_container_width=True, hide_index=True)
 
     # Copy expander
     with st.expander("📋 Copy Sections", expanded=False):
-        st.text_area("Executive (copy)", st.session_state.exec_summary, height=200)
-        st.text_area("Narrative (copy)", st.session_state.narrative_summary, height=200)
-        st.text_area("Ideas (copy)", st.session_state.ideas_summary, height=200)
+        for n in range(1, len(summaries) + 1):
+            st.text_area(f"Q{n} Executive (copy)", st.session_state[f"exec_summary_{run}_{n}"], height=200)
+            st.text_area(f"Q{n} Narrative (copy)", st.session_state[f"narrative_summary_{run}_{n}"], height=200)
+            st.text_area(f"Q{n} Ideas (copy)", st.session_state[f"ideas_summary_{run}_{n}"], height=200)
+            st.code(quote_tables[n-1].to_csv(index=False), language=None)
 
     # PDF export
     if pdf_supported:
-        buf = BytesIO()
-        doc = SimpleDocTemplate(buf, pagesize=A4,
-            leftMargin=15*mm, rightMargin=15*mm, topMargin=15*mm, bottomMargin=15*mm)
-        styles = getSampleStyleSheet()
-        normal = styles['BodyText']
-        heading = styles['Heading2']
-        elems = []
-        # Logo with aspect ratio
-        if os.path.exists(logo_path):
-            img = PILImage.open(logo_path)
-            ratio = img.height/img.width
-            elems.append(RLImage(logo_path, width=40*mm, height=40*mm*ratio))
-        # Metadata including questions
-        meta = f"Project {ctx['project_no']} | Client: {ctx['client_name']} | Industry: {ctx['industry']} | Generated: {datetime.now():%Y-%m-%d %H:%M}"
-        elems.append(Paragraph(meta, normal)); elems.append(Spacer(1,5*mm))
-        elems.append(Paragraph("Questions:", heading));
-        for q in ctx['questions']:
-            elems.append(Paragraph(f"- {q}", normal));
-        elems.append(PageBreak())
-        # Exec page
-        elems.append(Paragraph("Executive Summary", heading))
-        for line in exec_text.split("\n"): elems.append(Paragraph(f"- {line}", normal))
-        elems.append(PageBreak())
-        # Narrative page
-        elems.append(Paragraph("Narrative Summary", heading))
-        elems.append(Paragraph(narrative, normal)); elems.append(PageBreak())
-        # Ideas page
-        elems.append(Paragraph("Ideas Worth Exploring", heading))
-        for line in ideas_text.split("\n"): elems.append(Paragraph(f"- {line}", normal))
-        elems.append(PageBreak())
-        # Quotes page
-        elems.append(Paragraph("Top Quotes", heading))
-        for rid, txt in quotes: elems.append(Paragraph(f"<b>{rid}</b>: {txt}", normal))
-        doc.build(elems)
-        buf.seek(0)
-        st.download_button("⬇️ Download PDF", buf,
+        st.download_button("⬇️ Download PDF", build_pdf(ctx, summaries),
             file_name=f"OptiCoder_{ctx['project_no']}.pdf", mime='application/pdf')
     else:
         st.info("PDF unavailable — install reportlab.")
@@ -221,14 +377,17 @@ Questions:
     # Action buttons
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        if st.button("🔄 Re-run with feedback"): st.experimental_rerun()
+        # Regenerate on the next fragment run; the identical prompt hits Anthropic's prompt cache
+        st.button("🔄 Re-run with feedback", on_click=lambda: st.session_state.update(_regenerate=True))
     with col2:
-        if st.button("➡️ Next Question"): st.session_state.raw = ''; st.experimental_rerun()
+        st.button("➡️ Next Question", on_click=next_question)
     with col3:
-        if st.button("➕ New Project"): st.session_state.clear(); st.experimental_rerun()
+        if st.button("➕ New Project"): st.session_state.clear(); st.rerun()
     with col4:
         if st.button("❌ Quit"): st.stop()
 
+generation_block(ctx, raw)
+
 # Sidebar context
 st.sidebar.header("Project Context")
 for k, v in ctx.items(): st.sidebar.markdown(f"**{k.replace('_',' ').title()}:** {v}")